@@ -0,0 +1,195 @@
+"""FeatureStore and NearDuplicateIndex: persistence, crash repair, forked writers, lookup guarantees"""
+import importlib.util
+import os
+import random
+import sys
+from dataclasses import replace
+from pathlib import Path
+
+import numpy as np
+import pytest
+from PIL import Image
+
+MODULE_PATH = Path(__file__).resolve().parent.parent / 'Task 3.py'
+
+
+def _load_module():
+    spec = importlib.util.spec_from_file_location('caption_service', MODULE_PATH)
+    module = importlib.util.module_from_spec(spec)
+    # dataclasses look their module up in sys.modules
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+caption = _load_module()
+VECTOR_LENGTH = len(caption.FEATURE_VECTOR_FIELDS)
+
+
+@pytest.fixture(scope='module')
+def features():
+    """Features of a small synthetic photo, analyzed once"""
+    rng = np.random.default_rng(0)
+    pixels = rng.integers(0, 256, (120, 160, 3), dtype=np.uint8)
+    pixels[:40] = (110, 160, 230)  # a sky band gives the composition something to find
+    model = caption.ImprovedImageCaptioningAI()
+    return model.extract_features(Image.fromarray(pixels))
+
+
+def _key(number):
+    return caption.content_hash(f"image {number}".encode())
+
+
+# ---------------------------------------------------------------- FeatureStore
+
+def test_feature_store_round_trips_after_reopen(tmp_path, features):
+    store = caption.FeatureStore(str(tmp_path))
+    store.add(_key(0), features)
+    store.add(_key(1), replace(features, width=4000, height=3000))
+
+    reopened = caption.FeatureStore(str(tmp_path))
+    assert len(reopened) == 2
+    assert reopened.get(_key(0)) == features
+    assert reopened.get(_key(1)) == replace(features, width=4000, height=3000)
+    expected = np.array(features.to_vector(), dtype='<f4')
+    assert np.array_equal(np.array(reopened.get(_key(0)).to_vector(), dtype='<f4'), expected)
+    assert reopened.get(_key(2)) is None
+
+
+def test_feature_store_ignores_duplicate_keys(tmp_path, features):
+    store = caption.FeatureStore(str(tmp_path))
+    store.add(_key(0), features)
+    store.add(_key(0), replace(features, width=1))
+    assert len(caption.FeatureStore(str(tmp_path))) == 1
+    assert store.get(_key(0)) == features
+
+
+@pytest.mark.parametrize('torn_column, torn_bytes', [
+    ('features.bin', 4 * VECTOR_LENGTH // 2),   # half a vector after the last complete row
+    ('keys.bin', 32),                           # a key whose vector was never written
+    ('keys.bin', 13),                           # part of a key
+])
+def test_feature_store_truncates_half_written_row(tmp_path, features, torn_column, torn_bytes):
+    store = caption.FeatureStore(str(tmp_path))
+    store.add(_key(0), features)
+    store.add(_key(1), features)
+    sizes = {name: os.path.getsize(tmp_path / name) for name in ('keys.bin', 'features.bin')}
+    with open(tmp_path / torn_column, 'ab') as f:
+        f.write(b'\xff' * torn_bytes)
+
+    reopened = caption.FeatureStore(str(tmp_path))
+    assert len(reopened) == 2
+    assert {name: os.path.getsize(tmp_path / name) for name in sizes} == sizes
+    assert reopened.get(_key(1)) == features
+    # Rows added after the repair line up again
+    reopened.add(_key(2), replace(features, width=7))
+    assert caption.FeatureStore(str(tmp_path)).get(_key(2)) == replace(features, width=7)
+
+
+def test_feature_store_rejects_other_layouts(tmp_path):
+    (tmp_path / 'keys.bin').write_bytes(b'FST1' + (VECTOR_LENGTH + 1).to_bytes(4, 'little'))
+    with pytest.raises(ValueError):
+        caption.FeatureStore(str(tmp_path))
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason="needs fork")
+def test_feature_store_concurrent_appends_from_forked_processes(tmp_path, features):
+    processes, per_process, shared = 4, 150, 20
+    # Opened before the fork, so the children inherit the parent's file handles
+    store = caption.FeatureStore(str(tmp_path))
+    children = []
+    for worker in range(processes):
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                for number in range(per_process):
+                    store.add(_key(f"{worker}-{number}"), replace(features, width=worker, height=number))
+                    if number < shared:
+                        # Every child also races to add the same keys
+                        store.add(_key(f"shared-{number}"), replace(features, width=number))
+                status = 0
+            finally:
+                os._exit(status)
+        children.append(pid)
+    for pid in children:
+        _, status = os.waitpid(pid, 0)
+        assert os.waitstatus_to_exitcode(status) == 0
+
+    reopened = caption.FeatureStore(str(tmp_path))
+    assert len(reopened) == processes * per_process + shared
+    for worker in range(processes):
+        for number in range(per_process):
+            assert reopened.get(_key(f"{worker}-{number}")) == replace(features, width=worker, height=number)
+    for number in range(shared):
+        assert reopened.get(_key(f"shared-{number}")) == replace(features, width=number)
+    # The parent's handle sees the children's rows too
+    assert store.get(_key("3-0")) == replace(features, width=3, height=0)
+
+
+# ---------------------------------------------------------- NearDuplicateIndex
+
+def _vector(number):
+    return [float(number)] * VECTOR_LENGTH
+
+
+def _flip(value, bits):
+    for bit in bits:
+        value ^= 1 << bit
+    return value
+
+
+def _spread_bits(rng, distance):
+    """distance bit positions dealt round-robin over the 16-bit chunks, the hardest case for the probes"""
+    chunks = [rng.sample(range(16), 16) for _ in range(caption.PHASH_CHUNKS)]
+    return [16 * (index % caption.PHASH_CHUNKS) + chunks[index % caption.PHASH_CHUNKS][index // caption.PHASH_CHUNKS]
+            for index in range(distance)]
+
+
+@pytest.fixture(scope='module')
+def stored_hashes():
+    # Enough entries that most sit in the sorted buckets rather than the unindexed tail
+    rng = random.Random(1)
+    return [rng.getrandbits(64) for _ in range(6000)]
+
+
+@pytest.mark.parametrize('max_distance', [0, 3, 4, 7, 8, 12])
+def test_near_duplicate_lookup_finds_everything_within_max_distance(stored_hashes, max_distance):
+    index = caption.NearDuplicateIndex(max_distance)
+    for number, value in enumerate(stored_hashes):
+        index.add((value, (120, 90, 60)), _vector(number))
+    assert index._indexed > 0
+
+    rng = random.Random(max_distance)
+    for number in rng.sample(range(len(stored_hashes)), 200):
+        for distance in range(max_distance + 1):
+            for bits in (rng.sample(range(64), distance), _spread_bits(rng, distance)):
+                query = _flip(stored_hashes[number], bits)
+                assert index.lookup((query, (120, 90, 60))) == _vector(number), (number, bits)
+
+
+def test_near_duplicate_lookup_misses_beyond_max_distance_and_other_colors(stored_hashes):
+    index = caption.NearDuplicateIndex(4)
+    for number, value in enumerate(stored_hashes[:100]):
+        index.add((value, (120, 90, 60)), _vector(number))
+    rng = random.Random(2)
+    value = stored_hashes[5]
+    # Random 64-bit hashes sit about 32 bits apart, so nothing else is near
+    assert index.lookup((_flip(value, rng.sample(range(64), 5)), (120, 90, 60))) is None
+    far_color = (120 + caption.PHASH_COLOR_TOLERANCE + 1, 90, 60)
+    assert index.lookup((value, far_color)) is None
+
+
+def test_near_duplicate_index_reloads_and_drops_torn_tail(tmp_path, stored_hashes):
+    path = tmp_path / 'phash.idx'
+    index = caption.NearDuplicateIndex(8, str(path))
+    for number, value in enumerate(stored_hashes[:50]):
+        index.add((value, (10, 20, 30)), _vector(number))
+    size = os.path.getsize(path)
+    with open(path, 'ab') as f:
+        f.write(b'\x00' * 7)
+
+    reopened = caption.NearDuplicateIndex(8, str(path))
+    assert len(reopened) == 50
+    assert os.path.getsize(path) == size
+    assert reopened.lookup((_flip(stored_hashes[49], [0, 20, 40]), (10, 20, 30))) == _vector(49)